@@ -1,7 +1,32 @@
 import pandas as pd, numpy as np, time, pickle
+from sklearn.base import clone
 from sklearn.utils import resample
 from sklearn.model_selection import StratifiedKFold
 from sklearn.metrics import f1_score, precision_score, recall_score, accuracy_score
+from numba import njit
+
+
+@njit(cache=True)
+def overlap_loop(acq_dates, manure_dates, results):
+    '''
+    This function marks, inside the results array, the consequent acquisitions that contain at least one manure date. It is
+    used as a fallback of the vectorized search when the acquisition dates are not sorted.
+
+    Parameters:
+        acq_dates (numpy array): The acquisition dates of a crop field, as int64 nanoseconds.
+        manure_dates (numpy array): The manure dates of the same crop field, as int64 nanoseconds.
+        results (numpy array): A float64 array (same length of acq_dates) filled in place with 1 where a manure date is
+        within (acq_dates[j], acq_dates[j+1]].
+
+    Returns:
+        None.
+    '''
+    results[0] = np.nan
+    for j in range(len(acq_dates) - 1):
+        for i in range(len(manure_dates)):
+            if (acq_dates[j] < manure_dates[i] <= acq_dates[j+1]):
+                results[j+1] = 1.0
+                break
 
 
 def get_modified_df(s_df, satellite):
@@ -36,14 +61,21 @@ def get_modified_df(s_df, satellite):
     # Add a column y that contains 1 if one of the manure dates is within two consequent_xx_acquisition_date for a specific crop field,
     # otherwise 0
     def check_overlap(crop_df):
-        manure_dates = crop_df['manure_dates'].apply(lambda x: pd.to_datetime(eval(x)) if isinstance(x, str) else []).tolist()
-        s2_dates = crop_df[acq_date_col_name].tolist()
-        results = [np.NAN] + [0] * (len(s2_dates) - 1)
-        for j in range(0, len(s2_dates) - 1):
-            for i in range(len(manure_dates)):
-                if (s2_dates[j] < manure_dates[i] <= s2_dates[j+1]):
-                    results[j+1] = 1
-                    break
+        # Convert both the acquisition dates and the (unique) manure dates to numpy datetime64, so that comparisons
+        # are performed on plain int64 values rather than on pandas Timestamp objects
+        acq_dates = crop_df[acq_date_col_name].values.astype('datetime64[ns]')
+        manure_dates = np.unique(np.asarray([d for x in crop_df['manure_dates'] if isinstance(x, str) for d in eval(x)], dtype='datetime64[ns]'))
+        results = np.zeros(len(acq_dates), dtype=np.float64)
+        # The vectorized search requires sorted acquisition dates, otherwise fall back to the (jit-compiled) loop
+        if (len(acq_dates) > 1 and (np.diff(acq_dates) < np.timedelta64(0)).any()):
+            overlap_loop(acq_dates.view('int64'), manure_dates.view('int64'), results)
+            return pd.Series(results)
+        # For each manure date find the position of the first acquisition date greater or equal to it: the manure date
+        # is then within the two consequent acquisitions (pos-1, pos]
+        pos = np.searchsorted(acq_dates, manure_dates, side='left')
+        pos = pos[(pos > 0) & (pos < len(acq_dates))]
+        results[pos] = 1
+        results[0] = np.nan
         return pd.Series(results)
     
     # Add the column y
@@ -110,7 +142,7 @@ def get_balanced_df(s_df_mod, method, random_state=0):
     return restricted_df.sort_values(by=[s_df_mod.columns[0], s_df_mod.columns[1]]).reset_index(drop=True)
 
 
-def measure_scv_performances(X, y, model, scaler=None, n_folds=5, random_state=0, save=False):
+def measure_scv_performances(X, y, model, scaler=None, n_folds=5, random_state=0, save=False, dtype=np.float64):
     '''
     This function performs Stratified Cross-Validation for a given model and scaler using the KFold method, and returns a 
     DataFrame containing mean accuracy, precision, recall and f1-score for both train and test sets. It also prints a summary
@@ -124,6 +156,8 @@ def measure_scv_performances(X, y, model, scaler=None, n_folds=5, random_state=0
         n_folds (int): The number of folds to be used for stratified cross-validation (default 5).
         random_state (int): The random state to be used for the KFold object (default 0).
         save (boolean): Whether to save the obtained model and scaler, for later use (default False).
+        dtype (numpy dtype): The floating point type the features are converted to before fitting (default np.float64, which
+        most sklearn estimators, e.g. SVC and LogisticRegression, use internally without copying the data).
 
     Returns:
         pandas DataFrame: a DataFrame containing the different performance metrics results, considering the passed parameters.
@@ -131,6 +165,10 @@ def measure_scv_performances(X, y, model, scaler=None, n_folds=5, random_state=0
     # Define the stratified-cross-validation object
     kf = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=random_state)
 
+    # Convert the features to a C-contiguous array once, so that the estimators do not copy the folds internally at
+    # every fit/predict call (fancy indexing on a C-contiguous array keeps the folds C-contiguous)
+    X_arr = np.ascontiguousarray(X.to_numpy(dtype=dtype))
+
     # Initialize lists to store the results for each fold
     train_acc, test_acc = [], []
     train_prec, test_prec = [], []
@@ -140,20 +178,24 @@ def measure_scv_performances(X, y, model, scaler=None, n_folds=5, random_state=0
     start_time = time.time()
 
     for train_index, test_index in kf.split(X, y):
+        # Use fresh (unfitted) copies of the model and scaler, so that no state is shared between folds
+        fold_model = clone(model)
+        fold_scaler = clone(scaler) if scaler is not None else None
+
         # Normalize the train folds (if scaler not None)
-        X_train = X.iloc[train_index] if scaler == None else scaler.fit_transform(X.iloc[train_index])
+        X_train = X_arr[train_index] if fold_scaler is None else fold_scaler.fit_transform(X_arr[train_index])
         y_train = y.iloc[train_index]
         
         # Fit the logistic regression model
-        model.fit(X_train, y_train)
+        fold_model.fit(X_train, y_train)
         
         # Normalize the test fold (if scaler not None)
-        X_test = X.iloc[test_index] if scaler == None else scaler.transform(X.iloc[test_index])
+        X_test = X_arr[test_index] if fold_scaler is None else fold_scaler.transform(X_arr[test_index])
         y_test = y.iloc[test_index]
 
         # Predict the classes for the train and test fold
-        y_pred_train = model.predict(X_train)
-        y_pred_test = model.predict(X_test)
+        y_pred_train = fold_model.predict(X_train)
+        y_pred_test = fold_model.predict(X_test)
         
         # Calculate the evaluation metrics for the train and test fold
         train_acc.append(accuracy_score(y_train, y_pred_train))
@@ -168,10 +210,13 @@ def measure_scv_performances(X, y, model, scaler=None, n_folds=5, random_state=0
         train_f1.append(f1_score(y_train, y_pred_train, average='weighted', zero_division=0))
         test_f1.append(f1_score(y_test, y_pred_test, average='weighted', zero_division=0))
 
-    # Save the last model and scaler (if asked)
+    # Save the model and scaler fitted on the last fold (if asked)
     if (save):
-        pickle.dump(model, open('saved-config/model.pkl', 'wb'))
-        pickle.dump(scaler, open('saved-config/scaler.pkl', 'wb'))
+        # The folds are plain arrays, so attach the column names to the estimator that will receive the DataFrame at
+        # prediction time (the scaler, if used, otherwise the model): sklearn then still checks the features names and order
+        (fold_model if fold_scaler is None else fold_scaler).feature_names_in_ = np.asarray(X.columns, dtype=object)
+        pickle.dump(fold_model, open('saved-config/model.pkl', 'wb'))
+        pickle.dump(fold_scaler, open('saved-config/scaler.pkl', 'wb'))
     
     # Print the details
     print('Summary: ' + str(model) + ', ' + str(scaler) + ', ' + str(n_folds) + ' KFolds' + ', ' + str(round((time.time() - start_time), 3)) + 's\n')
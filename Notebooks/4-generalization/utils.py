@@ -1,5 +1,29 @@
 import pandas as pd, numpy as np, matplotlib.pyplot as plt
 from sklearn.preprocessing import MinMaxScaler, StandardScaler, MaxAbsScaler, RobustScaler
+from numba import njit
+
+
+@njit(cache=True)
+def overlap_loop(acq_dates, manure_dates, results):
+    '''
+    This function marks, inside the results array, the consequent acquisitions that contain at least one manure date. It is
+    used as a fallback of the vectorized search when the acquisition dates are not sorted.
+
+    Parameters:
+        acq_dates (numpy array): The acquisition dates of a crop field, as int64 nanoseconds.
+        manure_dates (numpy array): The manure dates of the same crop field, as int64 nanoseconds.
+        results (numpy array): A float64 array (same length of acq_dates) filled in place with 1 where a manure date is
+        within (acq_dates[j], acq_dates[j+1]].
+
+    Returns:
+        None.
+    '''
+    results[0] = np.nan
+    for j in range(len(acq_dates) - 1):
+        for i in range(len(manure_dates)):
+            if (acq_dates[j] < manure_dates[i] <= acq_dates[j+1]):
+                results[j+1] = 1.0
+                break
 
 
 def get_modified_df(s_df, satellite):
@@ -34,14 +58,21 @@ def get_modified_df(s_df, satellite):
     # Add a column y that contains 1 if one of the manure dates is within two consequent_xx_acquisition_date for a specific crop field,
     # otherwise 0
     def check_overlap(crop_df):
-        manure_dates = crop_df['manure_dates'].apply(lambda x: pd.to_datetime(eval(x)) if isinstance(x, str) else []).tolist()
-        s2_dates = crop_df[acq_date_col_name].tolist()
-        results = [np.NAN] + [0] * (len(s2_dates) - 1)
-        for j in range(0, len(s2_dates) - 1):
-            for i in range(len(manure_dates)):
-                if (s2_dates[j] < manure_dates[i] <= s2_dates[j+1]):
-                    results[j+1] = 1
-                    break
+        # Convert both the acquisition dates and the (unique) manure dates to numpy datetime64, so that comparisons
+        # are performed on plain int64 values rather than on pandas Timestamp objects
+        acq_dates = crop_df[acq_date_col_name].values.astype('datetime64[ns]')
+        manure_dates = np.unique(np.asarray([d for x in crop_df['manure_dates'] if isinstance(x, str) for d in eval(x)], dtype='datetime64[ns]'))
+        results = np.zeros(len(acq_dates), dtype=np.float64)
+        # The vectorized search requires sorted acquisition dates, otherwise fall back to the (jit-compiled) loop
+        if (len(acq_dates) > 1 and (np.diff(acq_dates) < np.timedelta64(0)).any()):
+            overlap_loop(acq_dates.view('int64'), manure_dates.view('int64'), results)
+            return pd.Series(results)
+        # For each manure date find the position of the first acquisition date greater or equal to it: the manure date
+        # is then within the two consequent acquisitions (pos-1, pos]
+        pos = np.searchsorted(acq_dates, manure_dates, side='left')
+        pos = pos[(pos > 0) & (pos < len(acq_dates))]
+        results[pos] = 1
+        results[0] = np.nan
         return pd.Series(results)
     
     # Add the column y